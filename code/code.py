@@ -24,8 +24,18 @@
 # A long-press of BUT1 will reset live status and start over checking if
 # the streamer is live.
 #
-# Pushing BUT3 and BUT4 (on the back of the HAXXOR Edition) currently do
-# nothing  but beep.
+# A long-press of BUT3 (on the back of the HAXXOR Edition) turns main loop
+# profiling on or off.  While it's on each phase of the loop is timed into
+# histogram buckets.  A long-press of BUT4 prints a summary of the timings
+# and the session log to the serial console.  When profiling is off it costs
+# one boolean check per phase, so leave it off unless you are chasing a slow
+# frame.
+#
+# A session log of boots, streams starting and ending, breaks, poll errors
+# and reboots is kept in microcontroller.nvm (see sessionlog.py) so it
+# survives resets.  If the WOPR restarts during a stream it picks up the
+# live time and break schedule from the log instead of codebreaking again.
+# Decode the log printed by BUT4 with tools/decode_session_log.py
 #
 # When the twitch status says the streamer has gone live it will calculate
 # how long the streamer has been live based on the twitch API and NTP
@@ -52,6 +62,7 @@ import random
 import adafruit_ticks
 import adafruit_requests
 import microcontroller
+import sessionlog
 
 DEBUG=True
 
@@ -60,6 +71,17 @@ UPDATE_DELAY = 63*1000   # units are ms
 REBOOT_DELAY = int(22*60*60*1000)  # arbitrary 22h restart period
 BREAK_DELAY = int(30*60*1000)   # ms
 
+# Main loop profiling, toggled with a long-press of BUT3.  Each phase gets a histogram
+# with one bucket per edge (phase took less than edge ms) plus an overflow bucket.
+PROFILE_PHASES = ("buttons","poll","golive","render","breaks","offline","log","total")
+PROFILE_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+PROFILE_BUCKETS_NS = tuple(b*1000000 for b in PROFILE_BUCKETS_MS)
+
+# Session log records are kept in RAM and written to flash in batches to limit wear,
+# when this many are waiting or they have been waiting this long
+LOG_FLUSH_RECORDS = 8
+LOG_FLUSH_DELAY = 5*60*1000   # ms
+
 WOPR_BUTTON_1=board.D2
 WOPR_BUTTON_2=board.D3
 WOPR_BUTTON_3=board.D7
@@ -102,7 +124,7 @@ def connect_wifi():
         pixel.fill(PIXEL_RED)
         defconLED.fill(PIXEL_RED)
         wopr_text("WiFi ERROR")
-        reboot_if_error(30)
+        reboot_if_error(30, sessionlog.REBOOT_WIFI)
     pixel.fill(PIXEL_GREEN)
     defconLED.fill(PIXEL_GREEN)
 
@@ -238,11 +260,13 @@ def wopr_solve(solved_code, solved_order):
         wopr_text("LIVE NOW ...")
         time.sleep(0.5)
 
-def reboot_if_error(delay):
+def reboot_if_error(delay, cause=sessionlog.REBOOT_ERROR):
     """
-    reboot the microcontroller after delay seconds delay
+    reboot the microcontroller after delay seconds delay.  The reboot is
+    recorded in the session log, which is flushed before resetting.
 
     :param delay: second to delay before rebooting
+    :param cause: why we're rebooting, one of the sessionlog.REBOOT_ causes
     """
     wopr_text("REBOOT {:02}s".format(delay),pad=True)
     pixel.fill(PIXEL_RED)
@@ -254,6 +278,8 @@ def reboot_if_error(delay):
         remaining=int(adafruit_ticks.ticks_diff(ticks_boot,adafruit_ticks.ticks_ms())/1000)
         wopr_text("REBOOT {:02}s".format(remaining),pad=True)
         time.sleep(0.1)
+    session_log.log(sessionlog.EVENT_REBOOT, time.time(), cause)
+    session_log.flush()
     #raise
     microcontroller.reset()
 
@@ -278,7 +304,8 @@ def get_twitch_start_time(twitch_token, streamer_name):
     except Exception as error:  # pylint: disable=broad-except
         print("Exception during status request: ",error)
         wopr_text("STATUS ERROR")
-        reboot_if_error(10)
+        session_log.log(sessionlog.EVENT_POLL_ERROR, time.time())
+        reboot_if_error(10, sessionlog.REBOOT_STATUS)
     if DEBUG:
         print("Data is",stream_data['data'])
 
@@ -392,6 +419,64 @@ def set_breaks_and_notices(t):
         break_notice[x]=adafruit_ticks.ticks_add(break_time,(-5+x)*60*1000)
         break_beep[x]=False
 
+def profile_reset():
+    """
+    Clear all the profiling histograms, max and total times
+    """
+    global profile_hist, profile_max, profile_total
+    profile_hist = {}
+    profile_max = {}
+    profile_total = {}
+    for phase in PROFILE_PHASES:
+        profile_hist[phase] = [0]*(len(PROFILE_BUCKETS_NS)+1)
+        profile_max[phase] = 0
+        profile_total[phase] = 0
+
+def profile_record(phase, t_start):
+    """
+    Add the time since t_start to the histogram for phase.  Returns the
+    current time so the next phase can start timing from it.
+
+    :param phase: name of the phase, one of PROFILE_PHASES
+    :param t_start: time.monotonic_ns() when the phase started
+    """
+    t_end = time.monotonic_ns()
+    elapsed = t_end - t_start
+    bucket = 0
+    while bucket < len(PROFILE_BUCKETS_NS) and elapsed >= PROFILE_BUCKETS_NS[bucket]:
+        bucket += 1
+    profile_hist[phase][bucket] += 1
+    profile_total[phase] += elapsed
+    if elapsed > profile_max[phase]:
+        profile_max[phase] = elapsed
+    return t_end
+
+def profile_dump():
+    """
+    Print a summary of the profiling histograms to the serial console
+    """
+    print("Profile summary, profiling is","on" if profiling else "off")
+    print("buckets (ms) <{} >={}".format(" <".join(str(b) for b in PROFILE_BUCKETS_MS),PROFILE_BUCKETS_MS[-1]))
+    for phase in PROFILE_PHASES:
+        count = sum(profile_hist[phase])
+        if count == 0:
+            print("{:8} no samples".format(phase))
+            continue
+        print("{:8} n {} mean {:.2f}ms max {:.2f}ms {}".format(phase, count,
+                profile_total[phase]/count/1000000, profile_max[phase]/1000000,
+                " ".join(str(n) for n in profile_hist[phase])))
+
+def reset_reason_code():
+    """
+    Index of microcontroller.cpu.reset_reason in sessionlog.RESET_REASONS so it
+    fits in a session log record, or -1 if it isn't one we know about
+    """
+    reason = microcontroller.cpu.reset_reason
+    for i in range(len(sessionlog.RESET_REASONS)):
+        if reason == getattr(microcontroller.ResetReason, sessionlog.RESET_REASONS[i], None):
+            return i
+    return -1
+
 # Neopixel LED setup 
 pixel = neopixel.NeoPixel(board.NEOPIXEL, 1, brightness=0.3, auto_write=True, pixel_order=neopixel.RGB)  # Neopixel on TinyS3
 defconLED = neopixel.NeoPixel(WOPR_DEFCON_LEDS, 5, brightness=0.5,auto_write=True)  # Five Neopixel on top of WOPR (0 -> 4 is right to left)
@@ -428,6 +513,14 @@ BUT4_raw.direction = digitalio.Direction.INPUT
 BUT4_raw.pull = digitalio.Pull.UP
 BUT4 = Button(BUT4_raw, value_when_pressed=True, long_duration_ms=1000)
 
+# Session log in non-volatile memory.  The clock isn't set from NTP yet so the
+# boot record's time is whatever the RTC has, the decoder knows about that.
+session_log = sessionlog.SessionLog(microcontroller.nvm)
+session_log.log(sessionlog.EVENT_BOOT, time.time(), reset_reason_code())
+print("Session log boot",session_log.boot_count,"with",session_log.count,"records")
+# If we were live when we reset, this is the stream to pick back up
+resume_start_time = session_log.live_start
+
 # Get WiFi Parameters and timezone 
 try:
     from secrets import secrets
@@ -450,7 +543,7 @@ except Exception as e:
     pixel.fill(PIXEL_RED)
     defconLED.fill(PIXEL_RED)
     wopr_text("TIME ERROR")
-    reboot_if_error(10)
+    reboot_if_error(10, sessionlog.REBOOT_TIME)
 print("current time:", format_datetime(time.localtime()))
 
 # Get streamer information to monitor, this should be you, eh. 
@@ -475,7 +568,7 @@ defconLED.fill(PIXEL_CYAN)
 token = get_twitch_token()
 if token is None:
     wopr_text("TWITCH ERROR")
-    reboot_if_error(10)
+    reboot_if_error(10, sessionlog.REBOOT_TOKEN)
 pixel.fill(PIXEL_GREEN)  # status light green
 defconLED.fill(PIXEL_GREEN)
 wopr_text("TWITCH OK")
@@ -488,10 +581,16 @@ streamer_live = False
 last_update_time = adafruit_ticks.ticks_add(adafruit_ticks.ticks_ms(),-2*UPDATE_DELAY)
 reboot_time = adafruit_ticks.ticks_add(adafruit_ticks.ticks_ms(), REBOOT_DELAY)
 set_breaks_and_notices(adafruit_ticks.ticks_ms())
+last_log_flush = adafruit_ticks.ticks_ms()
 color_index=0  # Color wheel
 color_direction=1  # which direction the color wheel moves
+profiling=False
+profile_reset()
 
 while True:
+    if profiling:
+        t_cycle = t_phase = time.monotonic_ns()
+
     BUT1.update()
     BUT2.update()
     BUT3.update()
@@ -506,11 +605,33 @@ while True:
         last_update_time = adafruit_ticks.ticks_add(adafruit_ticks.ticks_ms(),-2*UPDATE_DELAY)
         streamer_start_time = -1
         streamer_live = False 
+        resume_start_time = -1  # really start over, with the codebreak
         time.sleep(1)
     if BUT2.long_press:
         wopr_text("REBOOT")
         time.sleep(1)
-        reboot_if_error(10)
+        reboot_if_error(10, sessionlog.REBOOT_BUTTON)
+    if BUT3.long_press:
+        profiling = not profiling
+        if profiling:
+            wopr_text("PROFILE ON")
+            profile_reset()
+        else:
+            wopr_text("PROFILE OFF")
+        print("Profiling is","on" if profiling else "off")
+        time.sleep(1)
+        # Don't count the message on the display as part of the button phase
+        t_cycle = t_phase = time.monotonic_ns()
+    if BUT4.long_press:
+        wopr_text("DUMP")
+        profile_dump()
+        session_log.flush()
+        last_log_flush = adafruit_ticks.ticks_ms()
+        session_log.dump()
+        time.sleep(1)
+        t_cycle = t_phase = time.monotonic_ns()
+    if profiling:
+        t_phase = profile_record("buttons", t_phase)
 
     time_now = adafruit_ticks.ticks_ms()
 
@@ -533,9 +654,15 @@ while True:
             pixel.fill(PIXEL_RED)
             defconLED.fill(PIXEL_RED)
             print("Error getting streamer status:",e)
-            reboot_if_error(10)
+            session_log.log(sessionlog.EVENT_POLL_ERROR, time.time())
+            reboot_if_error(10, sessionlog.REBOOT_STATUS)
         pixel.fill(PIXEL_GREEN)
 
+        # The log says we were live but the stream ended while we weren't watching
+        if streamer_start_time == -1 and streamer_live==False and session_log.live_start != -1:
+            session_log.log(sessionlog.EVENT_OFFLINE, time.time(), -1)
+            resume_start_time = -1
+
         # Circuitpython boards are great, but if they run for really long
         # times the timing on clocks gets weird and slow.   We fix this by
         # just automatically resetting every day or so.  Only do it if
@@ -544,20 +671,36 @@ while True:
             print("Programmed reboot")
             wopr_text("REBOOT")
             defconLED.fill(PIXEL_GREEN)
-            reboot_if_error(5)
+            reboot_if_error(5, sessionlog.REBOOT_PROGRAMMED)
+        if profiling:
+            t_phase = profile_record("poll", t_phase)
 
     if streamer_start_time != -1 and streamer_live==False:
-        print(STREAMER_NAME,"has gone live")
-        code=['H','E','R','E',' ','W','E',' ','G','O']
-        code_solve_order=[0,1,2,3,5,6,8,9]
-        wopr_solve(code,randomize_list(code_solve_order))
+        if streamer_start_time == resume_start_time:
+            # We reset during this stream, so skip the codebreak and carry on with the
+            # break schedule from the session log.  Clamp it so a long time powered off
+            # just means a break is due now.
+            print(STREAMER_NAME,"is still live, resuming")
+            since_break = min(max(time.time()-session_log.break_at,0)*1000, BREAK_DELAY)
+            set_breaks_and_notices(adafruit_ticks.ticks_add(adafruit_ticks.ticks_ms(),-since_break))
+        else:
+            print(STREAMER_NAME,"has gone live")
+            code=['H','E','R','E',' ','W','E',' ','G','O']
+            code_solve_order=[0,1,2,3,5,6,8,9]
+            wopr_solve(code,randomize_list(code_solve_order))
+            session_log.log(sessionlog.EVENT_LIVE, time.time(), streamer_start_time)
+            set_breaks_and_notices(adafruit_ticks.ticks_ms())
+        resume_start_time = -1
         streamer_live=True
-        set_breaks_and_notices(adafruit_ticks.ticks_ms())
+        if profiling:
+            t_phase = profile_record("golive", t_phase)
 
     if streamer_start_time != -1 and streamer_live==True:
         live_time = time.time()-streamer_start_time
         live_time_str = seconds_to_hhmmss(live_time)
         wopr_text(live_time_str)
+        if profiling:
+            t_phase = profile_record("render", t_phase)
 
         if adafruit_ticks.ticks_less(break_notice[0], time_now):
             which_notice=-1
@@ -581,13 +724,17 @@ while True:
 
         if adafruit_ticks.ticks_less(break_time,time_now):
             wopr_text("TAKE A BREAK")
+            session_log.log(sessionlog.EVENT_BREAK, time.time(), session_log.breaks+1)
             defconLED.fill(PIXEL_BLACK)
             wopr_beep(1500,0.5,0.5)
             time.sleep(5)
             set_breaks_and_notices(time_now)
+        if profiling:
+            t_phase = profile_record("breaks", t_phase)
 
     if streamer_start_time == -1 and streamer_live==True:
         print(STREAMER_NAME,"has gone offline")
+        session_log.log(sessionlog.EVENT_OFFLINE, time.time(), time.time()-session_log.live_start)
         streamer_live=False
         wopr_text("GOODBYE ...")
         for x in range(5):
@@ -600,6 +747,18 @@ while True:
         streamer_live=False
         wopr_text("            ")
         defconLED.fill(PIXEL_BLACK)
-
+        if profiling:
+            t_phase = profile_record("offline", t_phase)
+
+    # Write the session log to flash in batches rather than every time something happens
+    if session_log.pending >= LOG_FLUSH_RECORDS or (session_log.pending > 0 and
+            adafruit_ticks.ticks_diff(time_now,last_log_flush) > LOG_FLUSH_DELAY):
+        session_log.flush()
+        last_log_flush = time_now
+        if profiling:
+            t_phase = profile_record("log", t_phase)
+
+    if profiling:
+        profile_record("total", t_cycle)
     time.sleep(.01)
     
\ No newline at end of file
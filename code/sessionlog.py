@@ -0,0 +1,189 @@
+# Session history log for the WOPR
+#
+# Keeps a compact history of what the WOPR has been up to (boots, streams
+# starting and ending, breaks, poll errors, reboots) across resets.  Events
+# are fixed-size binary records kept in a ring buffer in microcontroller.nvm,
+# so the oldest records get overwritten when it fills up.
+#
+# Records are buffered in RAM and only written out when flush() is called,
+# so code.py can batch them up and not wear out the flash or stall the
+# main loop writing one record at a time.
+#
+# The header also keeps the start time of the current stream and when the
+# break schedule last started, so a warm boot during a stream can pick up
+# where it left off without scanning the records.
+#
+# This file doesn't import anything CircuitPython specific so that
+# tools/decode_session_log.py can use it on the host to decode a dump.
+#
+import struct
+import binascii
+
+LOG_MAGIC = b"WLOG"
+LOG_VERSION = 1
+
+# magic, version, record size, capacity (records), head (next slot to write), record count,
+# boot count, breaks this stream, stream start time (unix, -1 if not live),
+# break schedule start time (unix)
+HEADER_FORMAT = "<4sBBHHHHHii"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# event, reserved, boot count, time (unix), value
+RECORD_FORMAT = "<BBHIi"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+# Prefix on the lines printed by dump(), for picking them out of a serial console capture
+DUMP_PREFIX = "SESSIONLOG "
+
+# Event types and what the value in the record means for each
+EVENT_BOOT = 1          # value: index into RESET_REASONS, -1 if unknown
+EVENT_LIVE = 2          # value: unix time the stream started according to twitch
+EVENT_OFFLINE = 3       # value: seconds the stream was live, -1 if it ended while the WOPR was off
+EVENT_BREAK = 4         # value: number of breaks so far this stream
+EVENT_POLL_ERROR = 5    # value: 0
+EVENT_REBOOT = 6        # value: one of the REBOOT_ causes
+
+EVENT_NAMES = {
+    EVENT_BOOT: "BOOT",
+    EVENT_LIVE: "LIVE",
+    EVENT_OFFLINE: "OFFLINE",
+    EVENT_BREAK: "BREAK",
+    EVENT_POLL_ERROR: "POLL_ERROR",
+    EVENT_REBOOT: "REBOOT",
+}
+
+# Reasons the WOPR decided to reboot itself
+REBOOT_ERROR = 0
+REBOOT_WIFI = 1
+REBOOT_TIME = 2
+REBOOT_TOKEN = 3
+REBOOT_STATUS = 4
+REBOOT_BUTTON = 5
+REBOOT_PROGRAMMED = 6
+
+REBOOT_NAMES = ("ERROR","WIFI","TIME","TOKEN","STATUS","BUTTON","PROGRAMMED")
+
+# Names of microcontroller.ResetReason values, in the order they are logged
+RESET_REASONS = ("POWER_ON","BROWNOUT","SOFTWARE","DEEP_SLEEP_ALARM",
+                 "RESET_PIN","WATCHDOG","UNKNOWN","RESCUE_DEBUG")
+
+class SessionLog:
+    """
+    Ring buffer of session events kept in a bytearray-like storage, usually
+    microcontroller.nvm.  If the storage doesn't have a valid log in it
+    (first run, or the format changed) it gets formatted.
+
+    :param storage: bytearray-like object to keep the log in
+    """
+    def __init__(self, storage):
+        self._storage = storage
+        self.capacity = (len(storage) - HEADER_SIZE) // RECORD_SIZE
+        self._pending = []
+        try:
+            (magic, version, record_size, capacity, self._head, self._count, self.boot_count,
+                self.breaks, self.live_start, self.break_at) = struct.unpack(HEADER_FORMAT, storage[0:HEADER_SIZE])
+        except (ValueError, RuntimeError):
+            magic = None
+        if (magic != LOG_MAGIC or version != LOG_VERSION or record_size != RECORD_SIZE
+                or capacity != self.capacity or self._head >= self.capacity or self._count > self.capacity):
+            self.format()
+
+    def format(self):
+        """
+        Throw away all the records and write an empty header
+        """
+        self._head = 0
+        self._count = 0
+        self.boot_count = 0
+        self.breaks = 0
+        self.live_start = -1
+        self.break_at = 0
+        self._pending = []
+        self._write_header()
+
+    def _write_header(self):
+        self._storage[0:HEADER_SIZE] = struct.pack(HEADER_FORMAT, LOG_MAGIC, LOG_VERSION, RECORD_SIZE,
+            self.capacity, self._head, self._count, self.boot_count, self.breaks,
+            self.live_start, self.break_at)
+
+    @property
+    def count(self):
+        """
+        Number of records written to storage
+        """
+        return self._count
+
+    @property
+    def pending(self):
+        """
+        Number of records waiting in RAM to be written by flush()
+        """
+        return len(self._pending)
+
+    def log(self, event, t, value=0):
+        """
+        Add an event to the log.  It is only buffered in RAM until flush() is called.
+        Logging EVENT_BOOT also bumps the boot count, EVENT_LIVE and EVENT_OFFLINE
+        keep track of the stream start time and EVENT_LIVE and EVENT_BREAK keep track
+        of when the break schedule started and how many breaks there have been.
+
+        :param event: one of the EVENT_ types
+        :param t: unix time the event happened
+        :param value: extra information about the event, see the EVENT_ types
+        """
+        if event == EVENT_BOOT:
+            self.boot_count = (self.boot_count + 1) & 0xFFFF
+        elif event == EVENT_LIVE:
+            self.live_start = value
+            self.break_at = t
+            self.breaks = 0
+        elif event == EVENT_BREAK:
+            self.break_at = t
+            self.breaks = value
+        elif event == EVENT_OFFLINE:
+            self.live_start = -1
+        self._pending.append(struct.pack(RECORD_FORMAT, event, 0, self.boot_count, t, value))
+
+    def flush(self):
+        """
+        Write all the buffered records and the header to storage.  Records are written
+        in at most two contiguous chunks (one if the ring doesn't wrap) to keep the
+        number of flash writes down.
+        """
+        if not self._pending:
+            return
+        # If there are more pending records than fit, only the newest survive anyway
+        records = self._pending[-self.capacity:]
+        self._pending = []
+        while records:
+            n = min(len(records), self.capacity - self._head)
+            start = HEADER_SIZE + self._head * RECORD_SIZE
+            self._storage[start:start + n * RECORD_SIZE] = b"".join(records[:n])
+            records = records[n:]
+            self._head = (self._head + n) % self.capacity
+            self._count = min(self._count + n, self.capacity)
+        self._write_header()
+
+    def records(self):
+        """
+        Generator of the records written to storage, oldest first, as tuples of
+        (event, boot count, unix time, value).  Records still pending are not included.
+        """
+        first = (self._head - self._count) % self.capacity
+        for i in range(self._count):
+            start = HEADER_SIZE + ((first + i) % self.capacity) * RECORD_SIZE
+            event, _, boot, t, value = struct.unpack(RECORD_FORMAT, self._storage[start:start + RECORD_SIZE])
+            yield (event, boot, t, value)
+
+    def dump(self, chunk_size=32):
+        """
+        Print the raw contents of the log as hex so it can be captured from the
+        serial console and decoded on the host with tools/decode_session_log.py.
+        Only the part of the storage that has been used is printed.
+
+        :param chunk_size: number of bytes per printed line
+        """
+        used = HEADER_SIZE + (self.capacity if self._count == self.capacity else self._head) * RECORD_SIZE
+        for start in range(0, used, chunk_size):
+            chunk = self._storage[start:min(start + chunk_size, used)]
+            print(DUMP_PREFIX + binascii.hexlify(chunk).decode())
@@ -0,0 +1,105 @@
+# Decode a WOPR session log on the host computer.
+#
+# Long-press BUT4 on the WOPR and it prints the session log to the serial
+# console as lines starting with "SESSIONLOG ".  Save the serial console
+# output to a file (or just copy and paste it) and run:
+#
+#   python tools/decode_session_log.py console.txt
+#
+# A raw binary copy of the log works too if you have one of those.
+#
+# Run it with regular python, not on the WOPR.
+#
+import os
+import sys
+import time
+import binascii
+import struct
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code"))
+import sessionlog
+
+# Anything earlier than this was logged before the clock got set from NTP
+CLOCK_SET_TIME = 1577836800  # 2020-01-01
+
+def read_log(filename):
+    """
+    Read the log data out of a serial console capture or a raw binary file
+
+    :param filename: file to read
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    if data.startswith(sessionlog.LOG_MAGIC):
+        return bytearray(data)
+    log = bytearray()
+    for line in data.decode(errors="replace").splitlines():
+        line = line.strip()
+        if line.startswith(sessionlog.DUMP_PREFIX):
+            log += binascii.unhexlify(line[len(sessionlog.DUMP_PREFIX):].strip())
+    return log
+
+def format_time(t):
+    """
+    Pretty-print a unix time from the log, in UTC like the WOPR keeps it
+
+    :param t: unix time
+    """
+    if t < CLOCK_SET_TIME:
+        return "(clock not set)    "
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(t))
+
+def format_value(event, value):
+    """
+    Describe the value stored with an event
+
+    :param event: one of the sessionlog.EVENT_ types
+    :param value: the value from the record
+    """
+    if event == sessionlog.EVENT_BOOT:
+        if 0 <= value < len(sessionlog.RESET_REASONS):
+            return "reset reason " + sessionlog.RESET_REASONS[value]
+        return "reset reason ?"
+    if event == sessionlog.EVENT_LIVE:
+        return "stream started " + format_time(value)
+    if event == sessionlog.EVENT_OFFLINE:
+        if value < 0:
+            return "live time unknown"
+        return "live for {:02}:{:02}:{:02}".format(value // 3600, value // 60 % 60, value % 60)
+    if event == sessionlog.EVENT_BREAK:
+        return "break {}".format(value)
+    if event == sessionlog.EVENT_REBOOT:
+        if 0 <= value < len(sessionlog.REBOOT_NAMES):
+            return "cause " + sessionlog.REBOOT_NAMES[value]
+        return "cause {}".format(value)
+    return ""
+
+def main():
+    if len(sys.argv) != 2:
+        print("usage: {} <console capture or binary log>".format(sys.argv[0]))
+        sys.exit(1)
+    data = read_log(sys.argv[1])
+    if len(data) < sessionlog.HEADER_SIZE or not data.startswith(sessionlog.LOG_MAGIC):
+        print("No session log found in", sys.argv[1])
+        sys.exit(1)
+    header = struct.unpack(sessionlog.HEADER_FORMAT, data[0:sessionlog.HEADER_SIZE])
+    version, record_size, capacity = header[1], header[2], header[3]
+    if version != sessionlog.LOG_VERSION or record_size != sessionlog.RECORD_SIZE:
+        print("Session log is version {} with {} byte records, this tool reads version {} with {} byte records".format(
+            version, record_size, sessionlog.LOG_VERSION, sessionlog.RECORD_SIZE))
+        sys.exit(1)
+    # The WOPR only prints the part of the log that has been used, pad it back out to full size
+    size = sessionlog.HEADER_SIZE + capacity * sessionlog.RECORD_SIZE
+    data += bytes(max(0, size - len(data)))
+    log = sessionlog.SessionLog(data[:size])
+
+    print("{} boots, {} of {} records used".format(log.boot_count, log.count, log.capacity))
+    if log.live_start != -1:
+        print("Live since", format_time(log.live_start), "with", log.breaks, "breaks, break schedule from",
+              format_time(log.break_at))
+    for event, boot, t, value in log.records():
+        name = sessionlog.EVENT_NAMES.get(event, "EVENT {}".format(event))
+        print("boot {:5} {} {:10} {}".format(boot, format_time(t), name, format_value(event, value)))
+
+if __name__ == "__main__":
+    main()